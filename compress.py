@@ -9,23 +9,60 @@ Created on Wed Dec  9 15:51:06 2020
 import logging
 from argparse import ArgumentParser
 
-_POOL_TIME = 10 # SECONDS
 _MAX_COMPRESS_TIME = 24 * 3600 # HOURS * SECONDS
-_MAX_POOL = _MAX_COMPRESS_TIME // _POOL_TIME
+_FLAG_CHUNK_SIZE = 128 * 1024**2 # BYTES
 
 from casacore.tables import table as CasacoreTable
 from casacore.tables import taql
 import shutil
 import os
-from subprocess import Popen as Process, TimeoutExpired, PIPE
+from subprocess import Popen as Process, TimeoutExpired, PIPE, CalledProcessError, check_call
 import numpy as np
-from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 
 
-def find_nearest(array, value):
+def find_nearest(array, values):
+    """
+    indices of the elements of {array} nearest to {values}
+    (the first one on ties, as argmin)
+    """
     array = np.asarray(array)
-    idx = (np.abs(array - value)).argmin()
-    return idx, array[idx]
+    values = np.atleast_1d(values).astype(array.dtype)
+    if len(array) == 1:
+        return np.zeros(len(values), dtype=np.intp)
+    steps = np.diff(array)
+    descending = (steps < 0).all()
+    if not descending and not (steps > 0).all():
+        # not monotonic, no binary search possible
+        return np.abs(np.subtract.outer(values, array)).argmin(axis=1)
+    if descending:
+        array = array[::-1]
+    idx = np.clip(np.searchsorted(array, values), 1, len(array) - 1)
+    dleft, dright = np.abs(values - array[idx - 1]), np.abs(array[idx] - values)
+    if descending:
+        # the right neighbour in the reversed array is the lower channel
+        return len(array) - 1 - (idx - (dleft < dright))
+    return idx - (dleft <= dright)
+
+
+def get_chan_freqs(msin):
+    """
+    channel frequencies of measurement set {msin}
+    """
+    # CHAN_FREQ of one spectral window is a few 10^4 values at most: fetch it once
+    # and search it in numpy (find_nearest) instead of one TaQL query per frequency
+    with taql(f'select CHAN_FREQ from {msin}::SPECTRAL_WINDOW limit 1') as spw:
+        return spw.getcell('CHAN_FREQ', 0)
+
+
+def get_chan_range(msfreqs, f_lo, f_hi):
+    """
+    first channel and number of channels of {msfreqs}
+    covering the interval [{f_lo}, {f_hi}]
+    """
+    chan0, chan1 = find_nearest(msfreqs, [f_lo, f_hi]).tolist()
+    # on a descending frequency axis f_hi maps to the lower channel
+    return min(chan0, chan1), abs(chan1 - chan0)
 
 
 def get_freq_chans(msin, freqs):
@@ -33,16 +70,10 @@ def get_freq_chans(msin, freqs):
     find channels numbers from measurement set {msin}
     which correspond to the frequencies {freqs} (float or array)
     """
-    if not isinstance(freqs, Iterable):
-        freqs = [freqs]
-    msfreqs = taql(f'select CHAN_FREQ from {msin}::SPECTRAL_WINDOW')[0]['CHAN_FREQ']
-    chans = []
-    for freq in freqs:
-        i, f = find_nearest(msfreqs, freq)
-        chans.append(i)
-    if len(chans) == 1:
-        chans = chans[0]
-    return chans
+    chans = find_nearest(get_chan_freqs(msin), freqs)
+    if np.ndim(freqs) == 0:
+        return int(chans[0])
+    return chans.tolist()
 
 
 def setup_logging(verbose=False):
@@ -52,6 +83,33 @@ def setup_logging(verbose=False):
         logging.basicConfig(level=logging.INFO)
 
 
+def copy_ms(msin_path, msout_path):
+    """
+    copy measurement set {msin_path} to {msout_path}. Uses copy-on-write
+    (reflink) where the filesystem supports it, so only the blocks that
+    are modified afterwards take up space and I/O.
+    """
+    if os.path.exists(msout_path):
+        shutil.rmtree(msout_path)
+    try:
+        check_call(['cp', '-a', '--reflink=auto', msin_path, msout_path])
+    except (OSError, CalledProcessError) as e:
+        logging.debug('cp failed (%s), falling back to shutil', e)
+        if os.path.exists(msout_path):
+            shutil.rmtree(msout_path)
+        os.makedirs(msout_path)
+        # table files and subtables are independent, copy them in parallel
+        def copy_entry(name):
+            src, dst = os.path.join(msin_path, name), os.path.join(msout_path, name)
+            if os.path.isdir(src):
+                shutil.copytree(src, dst, copy_function=shutil.copy)
+            else:
+                shutil.copy(src, dst)
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(copy_entry, os.listdir(msin_path)))
+    return msout_path
+
+
 def apply_flags(msin_path, flags_path, msout_path='', replace_edge_chans=False):
     """
     apply flags from flagtable to the data
@@ -60,43 +118,98 @@ def apply_flags(msin_path, flags_path, msout_path='', replace_edge_chans=False):
     if not msout_path:
         msout_path = msin_path
     else:
-        if os.path.exists(msout_path):
-            shutil.rmtree(msout_path)
-        shutil.copytree(msin_path, msout_path)
+        copy_ms(msin_path, msout_path)
     logging.debug('Applying flags to %s', msout_path)
 
-    def replace_1st_63rd_columns(flag_col):
-        nflags = flag_col.shape[1]
-        last = nflags//64 * 64
-        flag_col[:,1:last:64,:] = flag_col[:,2:last:64,:]
-        flag_col[:,63:last:64,:] = flag_col[:,62:last:64,:]
-        if nflags - last > 1:
-            flag_col[:,last+1,:] = flag_col[:,last+2,:]
-        return flag_col
+    def replace_1st_63rd_columns(table):
+        # only the sub-channel lanes 2 & 62 are read and 1 & 63 written,
+        # streamed in row chunks through one reused buffer
+        nrows = table.nrows()
+        nchan, npol = table.getcell('FLAG', 0).shape
+        for dst, src in ((1, 2), (63, 62)):
+            # a trailing partial block may miss sub-channel 2
+            n = min(len(range(dst, nchan, 64)), len(range(src, nchan, 64)))
+            if n == 0:
+                continue
+            chunk = min(nrows, max(1, _FLAG_CHUNK_SIZE // (n * npol)))
+            buf = np.empty((chunk, n, npol), dtype=bool)
+            for startrow in range(0, nrows, chunk):
+                lanes = buf[:min(chunk, nrows - startrow)]
+                table.getcolslicenp('FLAG', lanes, [src, 0], [src + 64*(n-1), npol-1], [64, 1], startrow, len(lanes))
+                table.putcolslice('FLAG', lanes, [dst, 0], [dst + 64*(n-1), npol-1], [64, 1], startrow, len(lanes))
+
+    def flag_col_shape(table):
+        # shape of the whole FLAG column without reading it
+        nrows = table.nrows()
+        if nrows == 0:
+            return (0,)
+        return (nrows,) + table.getcell('FLAG', 0).shape
 
     with CasacoreTable(msout_path, readonly=False) as table:
-        data_flag_col = table.getcol('FLAG')
+        data_flag_shape = flag_col_shape(table)
         flag_in = CasacoreTable(flags_path)
-        flag_col = flag_in.getcol('FLAG')
+        flag_shape = flag_col_shape(flag_in)
 
-        if data_flag_col.shape != flag_col.shape:
-            logging.error('FLAG columns shapes differ in DATA and Flagtable! (%s and %s)', data_flag_col.shape, flag_col.shape)
+        flag_expr = 't2.FLAG'
+        if data_flag_shape != flag_shape:
+            logging.error('FLAG columns shapes differ in DATA and Flagtable! (%s and %s)', data_flag_shape, flag_shape)
             raise RuntimeError('FLAG columns shapes differ in DATA and Flagtable!')
-            if flag_col.shape[1]//2 == data_flag_col.shape[1]:
+            if flag_shape[1]//2 == data_flag_shape[1]:
                 logging.info('Seems like the flagtable was created for the full band. Taking upper half...')
-                flag_col = flag_col[:,flag_col.shape[1]//2:,:]
+                flag_expr = f't2.FLAG[{flag_shape[1]//2}:,]'
             else:
                 raise RuntimeError('FLAG columns shapes differ in DATA and Flagtable!')
+        if data_flag_shape[0] == 0:
+            logging.info('%s has no rows. Nothing to flag', msout_path)
+            flag_in.close()
+            return msout_path
+        update = f'FLAG={flag_expr}'
+        if not np.array_equal(table.getcol('FLAG_ROW'), flag_in.getcol('FLAG_ROW')):
+            update += ', FLAG_ROW=t2.FLAG_ROW'
+        # rows of both tables are matched by row number, the copy runs inside casacore
+        taql(f'update $table set {update} from $flag_in t2')
         if replace_edge_chans:
             logging.info('Copying flags to sub-channels 1 & 62 from the neighboring channels')
-            flag_col = replace_1st_63rd_columns(flag_col)
-        table.putcol('FLAG', flag_col)
-        table.putcol('FLAG_ROW', flag_in.getcol('FLAG_ROW'))
+            replace_1st_63rd_columns(table)
+        flag_in.close()
     return msout_path
 
 
+def same_bytes(a, b, buf=None):
+    """
+    True if contiguous arrays {a} and {b} hold the same bytes.
+    Compares 8 bytes at a time; {buf} is an optional uint64 scratch buffer
+    """
+    if a.shape != b.shape:
+        return False
+    a, b = a.reshape(-1).view(np.uint8), b.reshape(-1).view(np.uint8)
+    n = a.size // 8
+    if not np.array_equal(a[8*n:], b[8*n:]):
+        return False
+    out = None if buf is None else buf[:n]
+    return not np.bitwise_xor(a[:8*n].view(np.uint64), b[:8*n].view(np.uint64), out=out).any()
+
+
 def test_same_flags(tab1, tab2):
-    res = np.array_equal(CasacoreTable(tab1).FLAG, CasacoreTable(tab2).FLAG)
+    """
+    compare FLAG columns of {tab1} and {tab2} chunk by chunk
+    """
+    t1 = CasacoreTable(tab1)
+    t2 = CasacoreTable(tab2)
+    nrows = t1.nrows()
+    res = nrows == t2.nrows()
+    if res and nrows > 0:
+        row_nbytes = t1.getcell('FLAG', 0).nbytes
+        chunk = max(1, _FLAG_CHUNK_SIZE // row_nbytes)
+        buf = np.empty(min(chunk, nrows) * row_nbytes // 8, dtype=np.uint64)
+        for startrow in range(0, nrows, chunk):
+            nrow = min(chunk, nrows - startrow)
+            if not same_bytes(t1.getcol('FLAG', startrow, nrow),
+                              t2.getcol('FLAG', startrow, nrow), buf):
+                res = False
+                break
+    t1.close()
+    t2.close()
     if res:
         logging.info('Flags are the same in %s and %s', tab1, tab2)
     else:
@@ -106,17 +219,17 @@ def test_same_flags(tab1, tab2):
 
 def execute_dppp(args):
     command = ['DPPP'] + args
-    logging.debug('executing %s', ','.join(command))
+    logging.debug('executing %s', command)
     dppp_process = Process(command)
-    for i in range(_MAX_POOL):
-        try:
-            return_code = dppp_process.wait(_POOL_TIME)
-            logging.debug('DPPP compression process %s finished with status: %s', dppp_process.pid, return_code)
-
-            return return_code
-        except TimeoutExpired as e:
-            logging.debug('DPPP compression process %s still running', dppp_process.pid)
-            continue
+    try:
+        return_code = dppp_process.wait(timeout=_MAX_COMPRESS_TIME)
+    except TimeoutExpired:
+        logging.error('DPPP process %s did not finish in %s s, killing it', dppp_process.pid, _MAX_COMPRESS_TIME)
+        dppp_process.kill()
+        dppp_process.wait()
+        raise
+    logging.debug('DPPP process %s finished with status: %s', dppp_process.pid, return_code)
+    return return_code
 
 
 def check_return_code(return_code):
@@ -127,7 +240,19 @@ def check_return_code(return_code):
         pass
 
 
-def split_ms(msin_path, startchan, nchan, msout_path=''):
+def tile_args(tilenchan=0, tilesize=0, step='msout'):
+    """
+    DPPP output {step} tiling options. 0 keeps the DPPP default
+    """
+    command_args = []
+    if tilenchan:
+        command_args.append(f'{step}.tilenchan={tilenchan}')
+    if tilesize:
+        command_args.append(f'{step}.tilesize={tilesize}')
+    return command_args
+
+
+def split_ms(msin_path, startchan, nchan, msout_path='', tilenchan=0, tilesize=0):
     """
     use casacore.tables.msutil.msconcat() to concat the new MS files
     """
@@ -139,14 +264,46 @@ def split_ms(msin_path, startchan, nchan, msout_path=''):
                     f'msin={msin_path}',
                     f'msin.startchan={startchan}',
                     f'msin.nchan={nchan}',
-                    f'msout={msout_path}']
+                    f'msout={msout_path}'] + tile_args(tilenchan, tilesize)
     return_code = execute_dppp(command_args)
     logging.debug('Split of %s returned status code %s', msin_path, return_code)
     check_return_code(return_code)
     return msout_path
 
 
-def compress(msin_path, msout_path='', bitrate=12):
+def split_ms_multi(msin_path, splits, tilenchan=0, tilesize=0):
+    """
+    split several channel ranges {splits} = [(startchan, nchan, msout_path), ...]
+    out of {msin_path} in a single pass over the data with the DP3 split step
+    (DP3 >= 5.1). Falls back to one split_ms per range if that run fails,
+    e.g. with an older DPPP build without the split step
+    """
+    # msin reads the full band once and each filter cuts out its own range
+    # (split_ms reads only its range via msin.startchan/msin.nchan instead).
+    # filter.nchan=0 is deliberate: like msin.nchan=0 it means "up to the last
+    # channel" and is used for the old-data upper half-band
+    startchans, nchans, msout_paths = zip(*splits)
+    logging.debug('Splitting file %s to %s', msin_path, msout_paths)
+    command_args = ['steps=[split]',
+                    'msout=',
+                    f'msin={msin_path}',
+                    'split.steps=[filter,out]',
+                    'split.replaceparms=[filter.startchan,filter.nchan,out.name]',
+                    f'filter.startchan=[{",".join(map(str, startchans))}]',
+                    f'filter.nchan=[{",".join(map(str, nchans))}]',
+                    f'out.name=[{",".join(msout_paths)}]',
+                    'out.overwrite=True'] + tile_args(tilenchan, tilesize, step='out')
+    return_code = execute_dppp(command_args)
+    logging.debug('Split of %s returned status code %s', msin_path, return_code)
+    if return_code != 0:
+        logging.warning('Single-pass split of %s failed (status %s). Splitting range by range',
+                        msin_path, return_code)
+        return [split_ms(msin_path, startchan, nchan, msout_path, tilenchan=tilenchan, tilesize=tilesize)
+                for startchan, nchan, msout_path in splits]
+    return list(msout_paths)
+
+
+def compress(msin_path, msout_path='', bitrate=12, tilenchan=0, tilesize=0):
     if not msout_path:
         msout_path = msin_path.replace('.MS', '_compressed.MS')
     logging.debug('Compressing file %s to %s', msin_path, msout_path)
@@ -155,7 +312,7 @@ def compress(msin_path, msout_path='', bitrate=12):
                     'msout.overwrite=True',
                     f'msin={msin_path}',
                     f'msout={msout_path}',
-                    f'msout.storagemanager.databitrate={bitrate}']
+                    f'msout.storagemanager.databitrate={bitrate}'] + tile_args(tilenchan, tilesize)
     return_code = execute_dppp(command_args)
     logging.debug('Compression of %s returned status code %s', msin_path, return_code)
     check_return_code(return_code)
@@ -180,11 +337,14 @@ def parse_args():
     parser.add_argument('-i', '--input', help='input MS')
     parser.add_argument('-o', '--output', default='', help='output MS (if empty -- the input is overwritten)')
     parser.add_argument('-f', '--flags', help='flag table to restore')
-    parser.add_argument('-b', '--bitrate', default=12, help='bitrate for dysco compression')
+    parser.add_argument('-b', '--bitrate', default=12, type=int, choices=[2, 3, 4, 6, 8, 10, 12, 16],
+                        help='bitrate for dysco compression')
+    parser.add_argument('--tilenchan', default=0, type=int, help='max number of channels per tile in the output MS (0 -- DPPP default)')
+    parser.add_argument('--tilesize', default=0, type=int, help='tile size in kB of the output MS columns (0 -- DPPP default)')
     parser.add_argument('-v', '--verbose', action='store_true')
     parser.add_argument('-n', '--newdata', action='store_true', help='Use it for data newer than Jan 2021.')
-    parser.add_argument('-d', '--decompress', default=False, action='store_true')
-    parser.add_argument('-c', '--clean', default=False, action='store_true', help='remove intermediate files')
+    parser.add_argument('-d', '--decompress', action='store_true')
+    parser.add_argument('-c', '--clean', action='store_true', help='remove intermediate files')
     return parser.parse_args()
 
 
@@ -196,21 +356,21 @@ def main():
     else:
 # split out 1180 -- 1200 MHz chunk
 # It's better to hardcode the freqs to prevent errors from typing in console:
-        freqs_interval_to_save = [1180.0e6, 1200.0e6] # by Tom
-        chans_interval_to_save = get_freq_chans(args.input, freqs_interval_to_save)
-        chan0 = chans_interval_to_save[0]
-        nchans = chans_interval_to_save[1] - chan0
-        if chan0 == 0 and nchans == 0: # ignore MS with band > 1180
+        msfreqs = get_chan_freqs(args.input)
+        chan0, nchans = get_chan_range(msfreqs, 1180.0e6, 1200.0e6) # by Tom
+        splits = []
+# nchans == 0 means the interval is outside the band. It must not reach DPPP,
+# which reads nchan=0 as "all channels" and would split the whole band
+        if nchans <= 0:
             logging.info('[1180-1200 MHz] is not in the data. Not splitting')
-            pass
         else:
-            _ = split_ms(args.input, chan0, nchans, msout_path=args.input.replace('.MS', f'_{chan0}_{nchans}.MS')) # to verify with Tom
+            splits.append((chan0, nchans, args.input.replace('.MS', f'_{chan0}_{nchans}.MS'))) # to verify with Tom
 # split out the 1400-1425 chunk -- Galactic HI
-        freqs_interval_to_save = [1400.0e6, 1425.0e6]
-        chans_interval_to_save = get_freq_chans(args.input, freqs_interval_to_save)
-        chan0 = chans_interval_to_save[0]
-        nchans = chans_interval_to_save[1] - chan0
-        _ = split_ms(args.input, chan0, nchans, msout_path=args.input.replace('.MS', f'_{chan0}_{nchans}.MS')) # to verify with Tom
+        chan0, nchans = get_chan_range(msfreqs, 1400.0e6, 1425.0e6)
+        if nchans <= 0:
+            logging.info('[1400-1425 MHz] is not in the data. Not splitting')
+        else:
+            splits.append((chan0, nchans, args.input.replace('.MS', f'_{chan0}_{nchans}.MS'))) # to verify with Tom
 # split upper subband:
 
         if args.newdata:
@@ -222,19 +382,25 @@ def main():
             nchans = 0
             replace_edge_chans = True
 
-        msout2 = split_ms(args.input, chan0, nchans, msout_path=args.input.replace('.MS', '_upper.MS')) # upper half-band
+        splits.append((chan0, nchans, args.input.replace('.MS', '_upper.MS'))) # upper half-band
+
+# all splits in one pass over the input
+        msout2 = split_ms_multi(args.input, splits, tilenchan=args.tilenchan, tilesize=args.tilesize)[-1]
 
         if not args.flags:
             logging.info('No flags provided. Not compressing.')
             return
 
         test_same_flags(msout2, args.flags) # will always differ if the edge chans are flagged
+# DPPP cannot take FLAG from an external flag table, so the flags are applied
+# between split and compress, to a (reflinked where possible) copy of the split
         flagged_ms_path = apply_flags(msout2,
                                       flags_path=args.flags,
                                       msout_path=msout2.replace('.MS', '_flagged.MS'),
                                       replace_edge_chans=replace_edge_chans)
         test_same_flags(flagged_ms_path, args.flags)
-        result = compress(flagged_ms_path, args.output, bitrate=args.bitrate)
+        result = compress(flagged_ms_path, args.output, bitrate=args.bitrate,
+                          tilenchan=args.tilenchan, tilesize=args.tilesize)
 
         if args.clean:
             logging.info('Removing intermediate files')